@@ -1,12 +1,11 @@
 #!/usr/bin/env python
 
 import argparse
-import json
 import math
 import random
 import re
+import signal
 import subprocess
-import sys
 import time
 import threading
 
@@ -18,6 +17,8 @@ from OpenGL.arrays import vbo
 
 import engine
 import glfw_app
+import ingest
+import profiling
 from glutils import *
 
 
@@ -292,6 +293,8 @@ class Renderer(object):
         #print window, key, scancode, action, mods
         if key == glfw_app.glfw.KEY_SPACE and action == glfw_app.glfw.PRESS:
             self.events.append('switch_viz')
+        elif key == glfw_app.glfw.KEY_P and action == glfw_app.glfw.PRESS:
+            self.events.append('toggle_profile')
 
     def set_viz(self, viz):
         if isinstance(viz, int):
@@ -302,10 +305,17 @@ class Renderer(object):
         self.last_render = time.time()
 
     def render_frame(self):
+        profiler.sync()
         if self.events:
             for event in self.events:
                 if event == 'switch_viz':
                     self.set_viz((self.visual_modes.index(self.viz) + 1) % len(self.visual_modes))
+                elif event == 'toggle_profile':
+                    profiler.toggle()
+                elif event == 'start_profile':
+                    profiler.start()
+                elif event == 'stop_profile':
+                    profiler.stop()
             self.events = []
         now = time.time()
         self.frame_elapsed = now - self.last_render
@@ -343,29 +353,36 @@ class Renderer(object):
 
 
 midi_engine = engine.Engine()
+profiler = profiling.Profiler(lambda: (renderer.viz, len(midi_engine.notes)))
 
-def run():
-    while True:
-        data = sys.stdin.readline().strip()
-        if data:
-            args = json.loads(data)
-            engine.tick()
-            with engine_lock:
-                func = getattr(midi_engine, {0x80: 'note_off', 0x90: 'note_on', 0xB0: 'damper'}[args[0]], None)
-                if func:
-                    func(*args[1:])
-                else:
-                    print("Unhandled MIDI event", args)
-            if args[0] == 0xB0 and args[1] == 0x42 and args[2] == 0:
-                renderer.events.append('switch_viz')
+def handle_event(event):
+    profiler.sync()
+    args = event.msg
+    engine.tick()
+    with engine_lock:
+        func = getattr(midi_engine, {0x80: 'note_off', 0x90: 'note_on', 0xB0: 'damper'}[args[0]], None)
+        if func:
+            func(*args[1:])
+        else:
+            print("Unhandled MIDI event", args)
+    if args[0] == 0xB0 and args[1] == 0x42 and args[2] == 0:
+        renderer.events.append('switch_viz')
 
 
 
 def main(args):
     global renderer
-    read_thread = threading.Thread(target=run)
-    read_thread.daemon = True
-    read_thread.start()
+    sources = [ingest.StdinSource()]
+    if args.udp:
+        (host, _, port) = args.udp.rpartition(':')
+        sources.append(ingest.UdpSource(host or '127.0.0.1', int(port)))
+    if args.unix:
+        sources.append(ingest.UnixSource(args.unix))
+    try:
+        ingest.Ingester(handle_event, sources, report_interval=args.ingest_stats).start()
+    except (OSError, ingest.IngestError) as e:
+        print("Error opening MIDI input:", e)
+        return
     try:
         match = re.search(r'Resolution:\s*(\d+) [Xx] (\d+)(.*)',
                           subprocess.check_output(['system_profiler', 'SPDisplaysDataType']).decode('ascii'))
@@ -380,6 +397,8 @@ def main(args):
         return
     renderer = Renderer(width, height)
     renderer.set_viz('keyboard')
+    signal.signal(signal.SIGUSR1, lambda signum, frame: renderer.events.append('start_profile'))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: renderer.events.append('stop_profile'))
     print("Entering render loop")
     app.key_callbacks.append(renderer.key_cb)
     app.run(renderer.render_frame)
@@ -389,4 +408,8 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--fullscreen', action='store_true')
+    parser.add_argument('--udp', metavar='[HOST:]PORT', help="also read OSC/JSON MIDI events from a UDP port")
+    parser.add_argument('--unix', metavar='PATH', help="also read JSON MIDI events from a Unix socket")
+    parser.add_argument('--ingest-stats', metavar='SECONDS', type=float,
+                        help="periodically print per-source throughput, lag and drops")
     main(parser.parse_args())
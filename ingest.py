@@ -0,0 +1,398 @@
+import asyncio
+import collections
+import json
+import math
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+NTP_EPOCH_OFFSET = 2208988800  # seconds from 1900-01-01 to 1970-01-01
+
+# time: when the event happened (source timestamp, or arrival if none was sent)
+# arrived: when we received it; msg: [status, data1, data2]
+Event = collections.namedtuple('Event', 'time arrived source msg')
+
+
+def parse_json_event(line):
+    """[status, data1, data2] with an optional trailing time.time() stamp"""
+    msg = json.loads(line)
+    if not (isinstance(msg, list) and 3 <= len(msg) <= 4 and all(isinstance(a, int) for a in msg[:3])):
+        raise ValueError("Expected [status, data1, data2(, time)], got %r" % (msg,))
+    if len(msg) > 3:
+        if isinstance(msg[3], bool) or not isinstance(msg[3], (int, float)):
+            raise ValueError("Expected a numeric time, got %r" % (msg[3],))
+        return (float(msg[3]), msg[:3])
+    return (None, msg)
+
+
+def read_osc_string(data, i):
+    end = data.index(b'\0', i)
+    return (data[i:end].decode('ascii'), (end + 4) & ~3)
+
+def parse_osc_packet(data, timestamp=None):
+    """Yield (timestamp, msg) pairs from an OSC message or (nested) bundle.
+
+    Only /midi messages are accepted, carrying either a single MIDI ('m')
+    argument or two or three ints.
+    """
+    if data.startswith(b'#bundle\0'):
+        (secs, frac) = struct.unpack_from('>II', data, 8)
+        if (secs, frac) != (0, 1):  # (0, 1) means "immediately"
+            timestamp = secs - NTP_EPOCH_OFFSET + frac / 2.0**32
+        i = 16
+        while i < len(data):
+            (size,) = struct.unpack_from('>i', data, i)
+            if size <= 0 or i + 4 + size > len(data):
+                raise ValueError("Bad OSC bundle element size %d" % size)
+            for item in parse_osc_packet(data[i+4:i+4+size], timestamp):
+                yield item
+            i += 4 + size
+        return
+    (address, i) = read_osc_string(data, 0)
+    if address != '/midi':
+        raise ValueError("Unsupported OSC address %s" % address)
+    (tags, i) = read_osc_string(data, i)
+    args = []
+    for tag in tags[1:]:
+        if tag == 'm':
+            args.extend(struct.unpack_from('4B', data, i)[1:])  # skip port id
+            i += 4
+        elif tag == 'i':
+            args.extend(struct.unpack_from('>i', data, i))
+            i += 4
+        elif tag == 'f':
+            (arg,) = struct.unpack_from('>f', data, i)
+            if not math.isfinite(arg):
+                raise ValueError("Non-finite float in %s" % address)
+            args.append(arg)
+            i += 4
+        elif tag == 's':
+            (_, i) = read_osc_string(data, i)
+        else:
+            raise ValueError("Unsupported OSC type tag %r in %s" % (tag, address))
+    if len(args) < 2:
+        raise ValueError("Too few arguments in %s" % address)
+    yield (timestamp, [int(a) for a in args[:3]])
+
+
+class Source(object):
+    """A bounded per-source event queue with throughput and lag counters.
+
+    When the queue is full, 'block' stops reading from the source until the
+    merger catches up (streams only; datagrams can't be pushed back on, so
+    they drop the oldest event instead), 'drop_oldest' evicts the head, and
+    'drop_newest' discards the incoming event.
+    """
+
+    def __init__(self, name, maxsize=256, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %r" % policy)
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.events = collections.deque()
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.reset_interval(time.time())
+
+    def reset_interval(self, now):
+        self.interval_start = now
+        self.interval_delivered = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def attach(self, ingester):
+        self.ingester = ingester
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def offer(self, timestamp, msg):
+        now = time.time()
+        self.received += 1
+        if len(self.events) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == 'drop_newest':
+                return
+            self.events.popleft()
+        self.events.append(Event(now if timestamp is None else timestamp, now, self, msg))
+        if len(self.events) >= self.maxsize:
+            self.not_full.clear()
+        self.ingester.wakeup.set()
+
+    async def put(self, timestamp, msg):
+        if self.policy == 'block':
+            while len(self.events) >= self.maxsize:
+                await self.not_full.wait()
+        self.offer(timestamp, msg)
+
+    def pop(self, now):
+        event = self.events.popleft()
+        self.not_full.set()
+        self.delivered += 1
+        self.interval_delivered += 1
+        lag = now - event.time
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        return event
+
+    def report(self, now):
+        """Summarize the interval since the last report, then start a new one"""
+        count = self.interval_delivered
+        line = "%s: %.1f ev/s, lag %.1f/%.1f ms avg/max, queued %d/%d, %d dropped" % (
+            self.name, count / max(now - self.interval_start, 1e-9),
+            1000 * self.lag_total / count if count else 0, 1000 * self.lag_max,
+            len(self.events), self.maxsize, self.dropped)
+        self.reset_interval(now)
+        return line
+
+    async def read_lines(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            await self.put_line(line.decode('utf-8', 'replace'))
+
+    async def put_line(self, line):
+        line = line.strip()
+        if line:
+            try:
+                (timestamp, msg) = parse_json_event(line)
+            except ValueError:
+                print("Bad event from %s: %r" % (self.name, line))
+                return
+            await self.put(timestamp, msg)
+
+    def log_crash(self, task):
+        """Done-callback for reader tasks, whose exceptions would otherwise go unseen"""
+        if not task.cancelled() and task.exception():
+            exc = task.exception()
+            print("%s stopped reading: %s: %s" % (self.name, type(exc).__name__, exc))
+
+    async def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StdinSource(Source):
+    def __init__(self, name='stdin', pipe=None, **kwargs):
+        super(StdinSource, self).__init__(name, **kwargs)
+        self.pipe = pipe or sys.stdin
+        self.transport = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        if os.isatty(self.pipe.fileno()):
+            # connect_read_pipe would set O_NONBLOCK on the tty, which stdout
+            # shares, so prints could then fail with BlockingIOError
+            self.task = asyncio.ensure_future(self.read_file())
+        else:
+            try:
+                (self.transport, _) = await loop.connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(reader), self.pipe)
+                self.task = asyncio.ensure_future(self.read_lines(reader))
+            except ValueError:
+                # regular files can't be watched by the event loop
+                self.task = asyncio.ensure_future(self.read_file())
+        self.task.add_done_callback(self.log_crash)
+
+    async def read_file(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, self.pipe.readline)
+            if not line:
+                break
+            await self.put_line(line)
+
+    def close(self):
+        self.task.cancel()
+        if self.transport:
+            self.transport.close()
+
+
+class UnixSource(Source):
+    """Newline-delimited JSON events from any client connecting to a Unix socket"""
+
+    def __init__(self, path, name=None, **kwargs):
+        super(UnixSource, self).__init__(name or 'unix:%s' % path, **kwargs)
+        self.path = path
+        self.tasks = set()
+
+    async def open(self):
+        self.unlink_socket()  # stale socket from a previous run
+        self.server = await asyncio.start_unix_server(self.handle_client, self.path)
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        task.add_done_callback(self.log_crash)
+        self.tasks.add(task)
+        try:
+            await self.read_lines(reader)
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+    def unlink_socket(self):
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise IngestError("%s exists and is not a socket" % self.path)
+        os.unlink(self.path)
+
+    def close(self):
+        self.server.close()
+        for task in self.tasks:
+            task.cancel()
+        self.unlink_socket()
+
+
+class UdpSource(Source):
+    """OSC packets, or newline-delimited JSON events, from a UDP port"""
+
+    def __init__(self, host, port, name=None, policy='drop_oldest', **kwargs):
+        super(UdpSource, self).__init__(name or 'udp:%d' % port, policy=policy, **kwargs)
+        self.host = host
+        self.port = port
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        (self.transport, _) = await loop.create_datagram_endpoint(
+            lambda: UdpProtocol(self), local_addr=(self.host, self.port))
+        if self.port == 0:
+            self.port = self.transport.get_extra_info('sockname')[1]
+            if self.name == 'udp:0':
+                self.name = 'udp:%d' % self.port
+
+    def datagram_received(self, data):
+        try:
+            if data.startswith(b'/') or data.startswith(b'#bundle'):
+                events = list(parse_osc_packet(data))
+            else:
+                events = [parse_json_event(line) for line in data.decode('utf-8').splitlines() if line.strip()]
+        except (ValueError, struct.error) as e:
+            print("Bad packet from %s: %s" % (self.name, e))
+            return
+        for (timestamp, msg) in events:
+            self.offer(timestamp, msg)
+
+    def close(self):
+        self.transport.close()
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, source):
+        self.source = source
+
+    def datagram_received(self, data, addr):
+        self.source.datagram_received(data)
+
+
+class Ingester(object):
+    """Merges events from several sources, in timestamp order, into dispatch().
+
+    With several sources, each event is held for `window` seconds after arrival
+    so that a slightly older event from another source can still be delivered
+    ahead of it. A single source is dispatched without delay.
+    """
+
+    def __init__(self, dispatch, sources, window=0.002, report_interval=None):
+        self.dispatch = dispatch
+        self.sources = sources
+        self.window = window
+        self.report_interval = report_interval
+        self.ready = None
+
+    def start(self, name='midi-reader'):
+        """Run in a daemon thread, returning once every source is open.
+
+        If a source can't be opened, its error is raised here instead.
+        """
+        self.ready = threading.Event()
+        self.open_error = None
+        thread = threading.Thread(target=self.run, name=name)
+        thread.daemon = True
+        thread.start()
+        self.ready.wait()
+        if self.open_error:
+            raise self.open_error
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+
+    async def serve(self):
+        self.wakeup = asyncio.Event()
+        for source in self.sources:
+            source.attach(self)
+        tasks = []
+        opened = []
+        try:
+            try:
+                for source in self.sources:
+                    await source.open()
+                    opened.append(source)
+            except Exception as e:
+                if self.ready is None:
+                    raise
+                self.open_error = e
+                return
+            finally:
+                if self.ready is not None:
+                    self.ready.set()
+            if self.report_interval:
+                tasks.append(asyncio.ensure_future(self.report()))
+            await self.merge()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for source in opened:
+                source.close()
+
+    def next_source(self):
+        heads = [s for s in self.sources if s.events]
+        if heads:
+            return min(heads, key=lambda s: s.events[0].time)
+
+    async def merge(self):
+        while True:
+            source = self.next_source()
+            if source is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            now = time.time()
+            delay = source.events[0].arrived + self.window - now
+            if delay > 0 and len(self.sources) > 1:  # nothing to reorder against otherwise
+                await asyncio.sleep(delay)
+                continue  # an older event may have come in meanwhile
+            event = source.pop(now)
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                print("Bad event from %s: %r (%s: %s)" % (source.name, event.msg, type(e).__name__, e))
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            now = time.time()
+            for source in self.sources:
+                print(source.report(now))
+
+
+class IngestError(Exception):
+    pass
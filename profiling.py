@@ -0,0 +1,163 @@
+import collections
+import cProfile
+import errno
+import os
+import pstats
+import sys
+import threading
+import time
+
+
+PROFILES_DIR = 'profiles'
+
+
+class Profiler(object):
+    """On-demand capture across several threads.
+
+    Each thread that should be profiled calls sync() once per iteration of its
+    loop; while no capture is running that is a single attribute check. During
+    a capture, every synced thread runs its own cProfile.Profile, and a sampler
+    thread folds their stacks into collapsed-stack (flamegraph) counts.
+
+    A cProfile can only be detached by its own thread, so after stop() each
+    thread lets go of its profile on its next sync(). The sampler thread waits
+    up to release_timeout for that before writing the capture; a thread that
+    is idle past then (e.g. the MIDI reader with no input) stays attached until
+    its next sync().
+    """
+
+    def __init__(self, get_tags, interval=0.005, outdir=PROFILES_DIR, release_timeout=1.0):
+        self.get_tags = get_tags  # returns (viz, note_count)
+        self.interval = interval
+        self.outdir = outdir
+        self.release_timeout = release_timeout
+        self.sampler = None
+        self.capturing = False
+        self.session = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def sync(self):
+        """Enable or disable this thread's cProfile to match the capture state"""
+        if not self.capturing and not getattr(self.local, 'profile', None):
+            return
+        with self.lock:
+            if getattr(self.local, 'session', None) != self.session or not self.capturing:
+                if getattr(self.local, 'profile', None):
+                    self.local.profile.disable()
+                    self.enabled.discard(self.local.profile)
+                    self.local.profile = None
+                if self.capturing:
+                    thread = threading.current_thread()
+                    self.local.profile = cProfile.Profile()
+                    self.local.session = self.session
+                    self.profiles.append(self.local.profile)
+                    self.thread_names[thread.ident] = thread.name
+                    try:
+                        self.local.profile.enable()
+                        self.enabled.add(self.local.profile)
+                    except ValueError:
+                        # newer Pythons allow one active cProfile, which already
+                        # sees every thread; sampling still covers this one
+                        self.profiles.remove(self.local.profile)
+                        self.local.profile = None
+
+    def toggle(self):
+        if self.capturing:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.capturing:
+            return
+        if self.sampler and self.sampler.is_alive():
+            print("Previous profile capture is still being written")
+            return
+        with self.lock:
+            self.session += 1
+            self.profiles = []
+            self.enabled = set()
+            self.thread_names = {}
+            self.stacks = collections.Counter()
+            self.max_notes = 0
+            self.started = time.time()
+            self.capturing = True
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='profile-sampler')
+        self.sampler.daemon = True
+        self.sampler.start()
+        print("Started profile capture")
+
+    def stop(self):
+        """End the capture; the sampler thread writes it out once threads let go"""
+        if not self.capturing:
+            return
+        with self.lock:
+            self.capturing = False
+        self.sync()  # detaches the calling thread's profile immediately
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        """Wait for the last capture to be written"""
+        if self.sampler:
+            self.sampler.join(timeout)
+
+    def finish(self):
+        deadline = time.time() + self.release_timeout
+        while True:
+            with self.lock:
+                pending = len(self.enabled)
+            if not pending or time.time() >= deadline:
+                break
+            time.sleep(self.interval)
+        if pending:
+            print("%d profiled thread(s) still attached; they detach on their next sync" % pending)
+        (viz, note_count) = self.get_tags()
+        with self.lock:
+            self.max_notes = max(self.max_notes, note_count)
+            stats = None
+            for profile in self.profiles:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+        self.write(viz, stats)  # outside the lock, so other threads' sync() isn't held up
+
+    def write(self, viz, stats):
+        try:
+            os.makedirs(self.outdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(self.outdir, '%s-%s-%dnotes' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)), viz, self.max_notes))
+        with open(path + '.folded', 'w') as f:
+            for (stack, count) in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        if stats is not None:
+            stats.dump_stats(path + '.prof')
+        print("Wrote %.1fs profile capture to %s.{folded,prof}" % (time.time() - self.started, path))
+
+    def sample(self):
+        self.collect()
+        self.finish()
+
+    def collect(self):
+        while not self.stop_event.wait(self.interval):
+            (viz, note_count) = self.get_tags()
+            frames = sys._current_frames()
+            with self.lock:
+                self.max_notes = max(self.max_notes, note_count)
+                for (ident, name) in self.thread_names.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.extend(['viz=%s' % viz, name])
+                    self.stacks[';'.join(reversed(stack))] += 1
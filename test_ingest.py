@@ -0,0 +1,198 @@
+import asyncio
+import fcntl
+import json
+import os
+import socket
+import struct
+import tempfile
+import time
+import types
+import unittest
+
+import ingest
+
+
+def osc_string(s):
+    s += b'\0'
+    return s + b'\0' * (-len(s) % 4)
+
+def osc_message(address, tags, payload=b''):
+    return osc_string(address) + osc_string(tags) + payload
+
+def osc_bundle(timestamp, *messages):
+    ntp = timestamp + ingest.NTP_EPOCH_OFFSET
+    data = b'#bundle\0' + struct.pack('>II', int(ntp), int(ntp % 1 * 2**32))
+    for message in messages:
+        data += struct.pack('>i', len(message)) + message
+    return data
+
+
+def attach_standalone(source):
+    """Attach a source to a stand-in for the Ingester, with no merge loop draining it"""
+    source.attach(types.SimpleNamespace(wakeup=asyncio.Event()))
+    return source
+
+
+class ParseTest(unittest.TestCase):
+    def test_osc_bundle_timetag(self):
+        timestamp = 1700000000.25
+        bundle = osc_bundle(timestamp,
+                            osc_message(b'/midi', b',m', bytes([0, 0x90, 60, 100])),
+                            osc_message(b'/midi', b',ii', struct.pack('>ii', 0x80, 60)))
+        events = list(ingest.parse_osc_packet(bundle))
+        self.assertEqual([msg for (_, msg) in events], [[0x90, 60, 100], [0x80, 60]])
+        for (t, _) in events:
+            self.assertAlmostEqual(t, timestamp, places=6)
+
+    def test_osc_rejects_other_messages(self):
+        with self.assertRaises(ValueError):
+            list(ingest.parse_osc_packet(osc_message(b'/ping', b',')))
+        with self.assertRaises(ValueError):
+            list(ingest.parse_osc_packet(osc_message(b'/midi', b',i', struct.pack('>i', 0x90))))
+        with self.assertRaises(ValueError):
+            list(ingest.parse_osc_packet(osc_message(b'/midi', b',if', struct.pack('>if', 0x90, float('inf')))))
+
+    def test_json_rejects_non_lists(self):
+        for line in ('5', '{"a": 1}', '[144, 60]', '["x", 60, 100]',
+                     '[144, 60, 100, null]', '[144, 60, 100, [1]]', '[144, 60, 100, true]'):
+            with self.assertRaises(ValueError):
+                ingest.parse_json_event(line)
+        self.assertEqual(ingest.parse_json_event('[144, 60, 100, 12.5]'), (12.5, [144, 60, 100]))
+
+
+class PolicyTest(unittest.TestCase):
+    def offer_all(self, policy):
+        async def go():
+            source = attach_standalone(ingest.Source('test', maxsize=2, policy=policy))
+            for i in range(5):
+                source.offer(None, [0x90, i, 100])
+            return source
+        return asyncio.run(go())
+
+    def test_drop_oldest(self):
+        source = self.offer_all('drop_oldest')
+        self.assertEqual(source.dropped, 3)
+        self.assertEqual([e.msg[1] for e in source.events], [3, 4])
+
+    def test_drop_newest(self):
+        source = self.offer_all('drop_newest')
+        self.assertEqual(source.dropped, 3)
+        self.assertEqual([e.msg[1] for e in source.events], [0, 1])
+
+    def test_block_pauses_reader(self):
+        async def go():
+            source = attach_standalone(ingest.Source('test', maxsize=2, policy='block'))
+            reader = asyncio.StreamReader()
+            for i in range(5):
+                reader.feed_data(('[144, %d, 100]\n' % i).encode('ascii'))
+            reader.feed_eof()
+            task = asyncio.ensure_future(source.read_lines(reader))
+            await asyncio.sleep(0.01)
+            self.assertEqual(source.received, 2)
+            self.assertFalse(task.done())
+            source.pop(time.time())
+            await asyncio.sleep(0.01)
+            self.assertEqual(source.received, 3)
+            while source.events:
+                source.pop(time.time())
+                await asyncio.sleep(0.01)
+            await task
+            self.assertEqual((source.received, source.delivered, source.dropped), (5, 5, 0))
+        asyncio.run(go())
+
+
+class IngesterTest(unittest.TestCase):
+    def serve(self, sources, send, dispatch=None):
+        """Run an Ingester over sources while send() feeds them; return what was dispatched"""
+        delivered = []
+        def record(event):
+            self.held = time.time() - event.arrived
+            delivered.append((event.source.name, event.msg))
+            if dispatch:
+                dispatch(event)
+        async def go():
+            ingester = ingest.Ingester(record, sources, window=0.05)
+            task = asyncio.ensure_future(ingester.serve())
+            await asyncio.sleep(0.05)
+            send()
+            await asyncio.sleep(0.2)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        asyncio.run(go())
+        return delivered
+
+    def test_merges_by_timestamp(self):
+        (read_fd, write_fd) = os.pipe()
+        stdin = ingest.StdinSource(pipe=os.fdopen(read_fd))
+        udp = ingest.UdpSource('127.0.0.1', 0)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        def send():
+            now = time.time()
+            os.write(write_fd, (json.dumps([0x90, 60, 100, now - 0.01]) + '\n').encode('ascii'))
+            sock.sendto(osc_bundle(now - 0.02, osc_message(b'/midi', b',m', bytes([0, 0x90, 64, 90]))),
+                        ('127.0.0.1', udp.port))
+        try:
+            delivered = self.serve([stdin, udp], send)
+        finally:
+            sock.close()
+            os.close(write_fd)
+        self.assertEqual(delivered, [(udp.name, [0x90, 64, 90]), ('stdin', [0x90, 60, 100])])
+
+    def test_dispatch_error_keeps_serving(self):
+        udp = ingest.UdpSource('127.0.0.1', 0)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        def send():
+            sock.sendto(b'[176, 1, 2]\n', ('127.0.0.1', udp.port))
+            time.sleep(0.01)
+            sock.sendto(b'[144, 60, 100]\n', ('127.0.0.1', udp.port))
+        def dispatch(event):
+            if event.msg[0] == 0xB0:
+                raise KeyError(event.msg[0])
+        try:
+            delivered = self.serve([udp], send, dispatch)
+        finally:
+            sock.close()
+        self.assertEqual([msg for (_, msg) in delivered], [[0xB0, 1, 2], [0x90, 60, 100]])
+        self.assertLess(self.held, 0.05)  # a lone source isn't held for the reorder window
+
+    def test_unix_source_delivers_and_cleans_up(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'midi.sock')
+            unix = ingest.UnixSource(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            def send():
+                sock.connect(path)
+                sock.sendall(b'[144, 60, 100, null]\n[144, 60, 100]\n[128, 60, 0]\n')
+            try:
+                delivered = self.serve([unix], send)
+            finally:
+                sock.close()
+            self.assertEqual(delivered, [(unix.name, [0x90, 60, 100]), (unix.name, [0x80, 60, 0])])
+            self.assertEqual(unix.received, 2)
+            self.assertFalse(os.path.exists(path))
+
+    def test_stdin_tty_stays_blocking(self):
+        (master_fd, slave_fd) = os.openpty()
+        tty = os.fdopen(slave_fd)
+        stdin = ingest.StdinSource(pipe=tty)
+        try:
+            # ^D ends the blocking readline, so asyncio.run can shut down its executor
+            self.serve([stdin], lambda: os.write(master_fd, b'[144, 60, 100]\n\x04'))
+            self.assertFalse(fcntl.fcntl(slave_fd, fcntl.F_GETFL) & os.O_NONBLOCK)
+            self.assertEqual(stdin.received, 1)
+        finally:
+            os.close(master_fd)
+            tty.close()
+
+    def test_unix_source_keeps_regular_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            with self.assertRaises(ingest.IngestError):
+                asyncio.run(ingest.Ingester(None, [ingest.UnixSource(f.name)]).serve())
+            self.assertTrue(os.path.exists(f.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
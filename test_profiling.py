@@ -0,0 +1,93 @@
+import glob
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import profiling
+
+
+def busy():
+    return sum(range(1000))
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.profiler = profiling.Profiler(lambda: ('spiral', 5), interval=0.001, outdir=self.tmp.name,
+                                           release_timeout=0.2)
+
+    def start_worker(self, iterations):
+        """A stand-in for the MIDI reader: syncs on each of its first `iterations` loops, then idles"""
+        self.worker_idle = threading.Event()
+        self.worker_done = threading.Event()
+        self.worker_profile = []
+        def work():
+            for _ in range(iterations):
+                self.profiler.sync()
+                busy()
+                time.sleep(0.001)
+            self.worker_profile.append(sys.getprofile())
+            self.worker_idle.set()
+            self.worker_done.wait()
+        worker = threading.Thread(target=work, name='midi-reader')
+        worker.daemon = True
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(self.worker_done.set)
+        return worker
+
+    def run_main(self, iterations):
+        for _ in range(iterations):
+            self.profiler.sync()
+            busy()
+            time.sleep(0.001)
+
+    def capture_files(self):
+        self.profiler.join()
+        (folded,) = glob.glob(os.path.join(self.tmp.name, '*-spiral-5notes.folded'))
+        (prof,) = glob.glob(os.path.join(self.tmp.name, '*-spiral-5notes.prof'))
+        return (folded, prof)
+
+    def test_capture_across_threads(self):
+        self.profiler.start()
+        self.start_worker(200)
+        self.run_main(50)
+        self.profiler.stop()
+        self.run_main(1)  # stop() already detached this thread; syncing again is harmless
+        (folded, prof) = self.capture_files()
+        with open(folded) as f:
+            prefixes = set(';'.join(line.split(';')[:2]) for line in f)
+        self.assertEqual(prefixes, {'MainThread;viz=spiral', 'midi-reader;viz=spiral'})
+        stats = pstats.Stats(prof)
+        self.assertTrue(any(func[2] == 'busy' for func in stats.stats))
+        self.worker_idle.wait()
+        self.assertEqual(self.worker_profile, [None])  # the reader let go of its profile by itself
+
+    def test_idle_thread_does_not_hold_up_the_capture(self):
+        self.profiler.start()
+        self.start_worker(5)
+        self.run_main(20)
+        self.profiler.stop()
+        self.profiler.join(timeout=2)
+        self.assertFalse(self.profiler.sampler.is_alive())
+        self.capture_files()
+
+    def test_sync_is_a_no_op_after_stop(self):
+        self.profiler.start()
+        self.run_main(5)
+        self.profiler.stop()
+        self.profiler.join()
+        self.assertIsNone(sys.getprofile())
+        with self.profiler.lock:
+            self.profiler.sync()  # would deadlock if it touched the lock
+        self.assertIsNone(sys.getprofile())
+        self.assertIsNone(self.profiler.local.profile)
+
+
+if __name__ == '__main__':
+    unittest.main()